@@ -1,11 +1,13 @@
 import os
 from threading import Thread
-from nltk.util import ngrams
 from collections import Counter
 import sys
-import chardet
 import math
 
+# The shared vocabulary module lives in the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from vocabulary import Vocabulary, can_pack_ngrams, pack_ngrams, unpack_ngram, most_common_packed
+
 def process_text_from_binary(binary_content):
     """
     Params:
@@ -27,9 +29,11 @@ def process_text_from_binary(binary_content):
 
     # While testing, I found some files to have different encodings(other than ascii/utf-8)
     # Hence, I have used chardet library to determine the encoding of the file and then decode it using that encoding format
+    # chardet is only imported when a file is actually not utf-8, most runs never need it
     try:
         text = binary_content.decode()
     except:
+        import chardet
         encoding_info = chardet.detect(binary_content)
         # print(encoding_info)
         text = binary_content.decode(encoding_info['encoding'])
@@ -42,16 +46,16 @@ def process_text_from_binary(binary_content):
 
     return filtered_text
 
-def get_n_grams_from_single_file(file_path, n_value):
+def get_word_ids_from_single_file(file_path, vocabulary):
     """
     Params:
     --------------
         file_path:  path to a file/document inside a class
-        n_value:    value of n for generating n-grams 
+        vocabulary: a `Vocabulary` shared by all documents of the class
     
     Output:
     --------------
-        Returns n-grams from a single document
+        Returns the words of a single document as an array of integer word ids
 
     Description:
     --------------
@@ -59,7 +63,7 @@ def get_n_grams_from_single_file(file_path, n_value):
         - reads the file from file_path
         - processes the text using `process_text_from_binary(...)` method
         - splits the string into words
-        - generates and returns the list of n grams using nltk library
+        - maps the words to their ids in the vocabulary, adding the new ones
     """
     with open(file_path, "rb") as f:
         file_content = f.read()
@@ -68,8 +72,7 @@ def get_n_grams_from_single_file(file_path, n_value):
     # print(file_path, processed_text)
     
     words = [word for word in processed_text.split(" ") if word!=""]
-    n_grams_list = list(ngrams(words, n_value))
-    return n_grams_list
+    return vocabulary.encode(words)
 
 def get_n_grams_with_score_from_single_class(class_path, n_value, k_value, tid):
     """
@@ -88,10 +91,11 @@ def get_n_grams_with_score_from_single_class(class_path, n_value, k_value, tid):
     --------------
         This function:
         - iterates through files present in a class from class_path
-        - processes the file using `get_n_grams_from_single_file(...)` method
-        - combines all the n_grams from each file into a list and gets the top-k n-grams from their frequency
+        - processes the file into word ids using `get_word_ids_from_single_file(...)` method
+        - packs the n_grams of each file into single integers and counts them with numpy to get the top-k n-grams
+          (falls back to counting tuples of word ids from the nltk library when numpy is missing or they do not fit into int64)
+        - decodes only the top-k n-grams back into words
         - Finally calculates their class-salience scores and returns it as a list of lists in the format: [n_gram, salience-score] 
-        - generates and returns the list of n grams using nltk library
     
     Reasoning:
     --------------
@@ -104,13 +108,30 @@ def get_n_grams_with_score_from_single_class(class_path, n_value, k_value, tid):
     documents = os.listdir(class_path)
     num_documents = len(documents)
     
-    n_grams_list = []
+    vocabulary = Vocabulary()
+    documents_word_ids = []
     for filename in documents:
         file_path = os.path.join(class_path, filename)
-        n_grams_list.extend(get_n_grams_from_single_file(file_path, n_value))
-
-
-    n_grams_with_frequency = Counter(n_grams_list).most_common(k_value)
+        documents_word_ids.append(get_word_ids_from_single_file(file_path, vocabulary))
+
+    vocabulary_size = len(vocabulary)
+    if can_pack_ngrams(n_value, vocabulary_size):
+        packed_n_grams = [pack_ngrams(word_ids, n_value, vocabulary_size) for word_ids in documents_word_ids]
+        n_grams_ids_with_frequency = [
+            (unpack_ngram(packed, n_value, vocabulary_size), freq)
+            for (packed, freq) in most_common_packed(packed_n_grams, k_value)
+        ]
+    else:
+        # nltk is only imported on this fallback path
+        from nltk.util import ngrams
+        n_grams_ids_with_frequency = Counter(
+            n_gram for word_ids in documents_word_ids for n_gram in ngrams(word_ids, n_value)
+        ).most_common(k_value)
+
+    n_grams_with_frequency = [
+        (tuple(vocabulary.decode(n_gram_ids)), freq)
+        for (n_gram_ids, freq) in n_grams_ids_with_frequency
+    ]
     # print(n_grams_with_frequency)
     n_grams_with_score = [
         [n_gram, freq/num_documents] 
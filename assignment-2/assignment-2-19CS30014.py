@@ -72,17 +72,19 @@ class KargerMincut:
     def construct_graph(self, edges:list):
         """
             - This function is used to construct the graph from the given edges
+            - An edge is either [u, v] or [u, v, count] for `count` parallel edges between u and v
         """
         self.graph = {}
         for edge in edges:
-            u, v = edge
+            u, v = edge[0], edge[1]
+            count = edge[2] if len(edge) > 2 else 1
             if u not in self.vertex_map:
                 self.vertex_map[u] = SpecialNode([u])
             if v not in self.vertex_map:
                 self.vertex_map[v] = SpecialNode([v])
             u = self.vertex_map[u]
             v = self.vertex_map[v]
-            self.add_edge(u, v)
+            self.add_edge(u, v, count)
 
         self.vertex_min = min(self.vertex_map.keys())
         self.vertex_max = max(self.vertex_map.keys())
@@ -212,6 +214,135 @@ class KargerMincut:
         min_cut = self.get_edge_count(edge[0], edge[1])
         return edge, min_cut
 
+class MincutPreprocessor:
+    """
+        - This class is used to shrink the graph before running the randomized Karger's algorithm
+        - Any vertex of degree d gives a cut of value d, so the minimum degree is an upper bound of the min cut
+        - A connected graph has a min cut of at least 1, so a vertex of degree 1 is already an optimal cut
+        - Iteratively removes vertices with at most two distinct neighbours, recording where they went:
+            - a pendant vertex (one neighbour) joins its neighbour, cutting it off alone is already covered by the bound
+            - a chain vertex (two neighbours a, b) is replaced by an edge a-b of weight min(w_a, w_b), and joins
+              the heavier neighbour, as in any other cut it can always follow one of them at that cost
+        - The min cut of the graph is the minimum of the bound and the min cut of the remaining core
+    """
+    def __init__(self, edges:list):
+        # Weighted adjacency: adjacency[u][v] = number of parallel edges between u and v
+        self.adjacency = {}
+        for edge in edges:
+            u, v = edge[0], edge[1]
+            self.adjacency.setdefault(u, {})
+            self.adjacency.setdefault(v, {})
+            # Self loops never cross a cut
+            if u == v:
+                continue
+            self.adjacency[u][v] = self.adjacency[u].get(v, 0) + 1
+            self.adjacency[v][u] = self.adjacency[v].get(u, 0) + 1
+
+        # removed vertex -> vertex it joined
+        self.attached_to = {}
+        # Best cut found without running the randomized algorithm: (value, vertices on one side)
+        self.bound = (infinity, None)
+
+    def degree(self, u):
+        return sum(self.adjacency[u].values())
+
+    def connected_components(self):
+        """
+            - This function is used to get the connected components of the graph, each as a list of vertices
+        """
+        visited = set()
+        components = []
+        for start in sorted(self.adjacency.keys()):
+            if start in visited:
+                continue
+            visited.add(start)
+            component = [start]
+            stack = [start]
+            while stack:
+                u = stack.pop()
+                for v in self.adjacency[u]:
+                    if v not in visited:
+                        visited.add(v)
+                        component.append(v)
+                        stack.append(v)
+            components.append(component)
+        return components
+
+    def trivial_cut(self):
+        """
+            - This function is used to get a cut which is optimal without any further work, if there is one
+            - Returns (0, one component) for a disconnected graph, and (1, [vertex]) for a vertex of degree 1
+            - Also records the minimum degree upper bound, returns (None, None) if that is not known to be optimal
+        """
+        components = self.connected_components()
+        if len(components) > 1:
+            return 0, components[0]
+
+        for u in sorted(self.adjacency.keys()):
+            if self.degree(u) < self.bound[0]:
+                self.bound = (self.degree(u), [u])
+        if self.bound[0] <= 1:
+            return self.bound
+        return None, None
+
+    def remove_vertex(self, u):
+        """
+            - This function is used to remove a vertex with at most two neighbours, and returns its former neighbours
+        """
+        neighbours = self.adjacency.pop(u)
+        for v in neighbours:
+            self.adjacency[v].pop(u)
+
+        if len(neighbours) == 1:
+            (v, _), = neighbours.items()
+            self.attached_to[u] = v
+        elif len(neighbours) == 2:
+            (a, w_a), (b, w_b) = neighbours.items()
+            self.attached_to[u] = a if w_a >= w_b else b
+            self.adjacency[a][b] = self.adjacency[a].get(b, 0) + min(w_a, w_b)
+            self.adjacency[b][a] = self.adjacency[b].get(a, 0) + min(w_a, w_b)
+        return list(neighbours.keys())
+
+    def reduce_to_core(self):
+        """
+            - This function is used to strip pendant vertices and chains until only the core is left
+            - Every removed vertex also updates the bound with the cut around itself and the vertices which joined it
+            - Returns the edges of the core in the format [u, v, count]
+        """
+        candidates = [u for u in self.adjacency if len(self.adjacency[u]) <= 2]
+        while candidates and len(self.adjacency) > 1:
+            u = candidates.pop()
+            if u not in self.adjacency or len(self.adjacency[u]) > 2:
+                continue
+            degree = self.degree(u)
+            if degree < self.bound[0]:
+                self.bound = (degree, self.members([u]))
+            for v in self.remove_vertex(u):
+                if len(self.adjacency[v]) <= 2:
+                    candidates.append(v)
+
+        return [
+            [u, v, count]
+            for u in self.adjacency for v, count in self.adjacency[u].items() if u < v
+        ]
+
+    def members(self, vertices:list):
+        """
+            - This function is used to get the vertices together with all the removed vertices which joined them
+            - Maps one side of a cut of the core back to the vertices of the original graph
+        """
+        children = {}
+        for v, parent in self.attached_to.items():
+            children.setdefault(parent, []).append(v)
+        members = list(vertices)
+        stack = list(vertices)
+        while stack:
+            for v in children.get(stack.pop(), []):
+                members.append(v)
+                stack.append(v)
+        return members
+
+
 def main():
     try:
         edgelist_file = sys.argv[1]
@@ -226,23 +357,33 @@ def main():
     # kargerMincutSimulator = KargerMincut(edgelist)
     # print(kargerMincutSimulator.graph)
 
-    min_cut = infinity
-    result = None
-    for i in range(3):
-        print(f"Running iteration-{i+1} ...")
-        kargerMincutSimulator = KargerMincut(graph_edgelist)
-        edge, current_min_cut = kargerMincutSimulator.run_algorithm()
-        if current_min_cut < min_cut:
-            min_cut = current_min_cut
-            result = edge
+    all_nodes = set(x for edge in graph_edgelist for x in edge)
+    preprocessor = MincutPreprocessor(graph_edgelist)
+    min_cut, side = preprocessor.trivial_cut()
+    if min_cut is not None:
+        print("Found an optimal cut without running the algorithm")
+    else:
+        core_edgelist = preprocessor.reduce_to_core()
+        min_cut, side = preprocessor.bound
+        print(f"Reduced the graph from {len(all_nodes)} to {len(preprocessor.adjacency)} vertices, min degree bound = {min_cut}")
+
+        # A core of a single vertex means the bound is already the exact min cut
+        if len(preprocessor.adjacency) > 1:
+            for i in range(3):
+                print(f"Running iteration-{i+1} ...")
+                kargerMincutSimulator = KargerMincut(core_edgelist)
+                edge, current_min_cut = kargerMincutSimulator.run_algorithm()
+                if current_min_cut < min_cut:
+                    min_cut = current_min_cut
+                    side = preprocessor.members(edge[0].get_node_values())
 
     # print(min_cut)
     print(f"Value of probable mincut = {min_cut}") 
     community = {}
-    for i in range(2):
-        special_node:SpecialNode = result[i]
-        for x in special_node.get_node_values():
-            community[x] = i+1
+    for x in all_nodes:
+        community[x] = 1
+    for x in side:
+        community[x] = 2
     
     print("Node-ID      Community-ID")
     print("----------------------")
@@ -1,8 +1,44 @@
-from pyspark import SparkConf, SparkContext
-from operator import add
+from array import array
+from contextlib import contextmanager
+import hashlib
+import heapq
+import random
+import json
+import time
+import os
 import sys
 import math
 
+# The shared vocabulary module lives in the root of the repository
+VOCABULARY_MODULE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, VOCABULARY_MODULE_DIR)
+from vocabulary import Vocabulary, build_vocabulary_rdd, encode_token_lists_rdd, decode_ids_rdd
+
+# Optional command line flags, given as `--name value` (or just `--name` for on/off switches)
+# after the four positional arguments. The default value also fixes the type of the flag.
+DEFAULT_OPTIONS = {
+    # Approximate mode: count-min sketches + space-saving heavy hitters instead of exact counts
+    "approx": False,
+    # Count-min sketch error bounds: estimates exceed the true count by at most
+    # epsilon * (total count) with probability at least 1 - delta
+    "epsilon": 0.0001,
+    "delta": 0.01,
+    # Number of candidate words tracked by each space-saving summary
+    "heavy_hitters": 5000,
+    # Context window mode: every W consecutive tokens of the whole stream form a document (0 = off)
+    "window": 0,
+    # Paragraph mode: documents are paragraphs separated by blank lines instead of single lines
+    "paragraphs": False,
+    # Directory of the preprocessed corpus cache, shared across runs (empty = no cache)
+    "cache_dir": "",
+    # Number of input partitions (0 = from the input size and the number of cores)
+    "input_partitions": 0,
+    # Number of partitions of the count shuffle (0 = same as the input)
+    "shuffle_partitions": 0,
+    # Spread the counts of every word over this many salted keys before the final sum (0 = off)
+    "salt": 0,
+}
+
 def print_sample(*args, **kwargs):
     print(50*"-")
     for arg in args:
@@ -11,6 +47,38 @@ def print_sample(*args, **kwargs):
         print(f"{key}: {value}")
     print(50*"-")
 
+def read_cmd_options(args):
+    # Parse the optional `--name value` flags, falling back to DEFAULT_OPTIONS
+    options = dict(DEFAULT_OPTIONS)
+    i = 0
+    while i < len(args):
+        name = args[i]
+        key = name[2:].replace("-", "_")
+        if not name.startswith("--") or key not in DEFAULT_OPTIONS:
+            raise Exception(f"Unknown option: {name}")
+        default = DEFAULT_OPTIONS[key]
+        if isinstance(default, bool):
+            options[key] = True
+            i += 1
+        else:
+            options[key] = type(default)(args[i+1])
+            i += 2
+    check_cmd_options(options)
+    return options
+
+def check_cmd_options(options):
+    # Reject out of range values here, instead of failing after spark has started
+    # and the corpus has been preprocessed
+    if not 0 < options["epsilon"] < 1:
+        raise Exception(f"--epsilon must be between 0 and 1, got {options['epsilon']}")
+    if not 0 < options["delta"] < 1:
+        raise Exception(f"--delta must be between 0 and 1, got {options['delta']}")
+    if options["heavy_hitters"] < 1:
+        raise Exception(f"--heavy-hitters must be at least 1, got {options['heavy_hitters']}")
+    for key in ["window", "salt", "input_partitions", "shuffle_partitions"]:
+        if options[key] < 0:
+            raise Exception(f"--{key.replace('_', '-')} must not be negative, got {options[key]}")
+
 def read_cmd_args():
     # Read command line arguments
     try:
@@ -19,9 +87,10 @@ def read_cmd_args():
         query_word = query_word.lower()
         k = int(sys.argv[3])
         stopword_file = sys.argv[4]
-        return data_file, query_word, k, stopword_file
-    except:
-        raise Exception("Invalid command line arguments!")
+        options = read_cmd_options(sys.argv[5:])
+        return data_file, query_word, k, stopword_file, options
+    except Exception as error:
+        raise Exception("Invalid command line arguments!") from error
 
 def read_stopwords(stopword_file):
     with open(stopword_file, 'r') as f:
@@ -37,20 +106,243 @@ def preprocess_document(document, stopwords):
     return words
 
 
+def file_hash(path):
+    # sha256 hex digest of a local file, read in chunks
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hadoop_path(sc, path):
+    # A path and the hadoop filesystem spark resolves it on, the one of its scheme or the default
+    # filesystem of spark (e.g. hdfs on a cluster) for paths without one. `textFile(...)` and
+    # `saveAsPickleFile(...)` use the same, while python file apis only ever see the local disk.
+    path = sc._jvm.org.apache.hadoop.fs.Path(path)
+    return path, path.getFileSystem(sc._jsc.hadoopConfiguration())
+
+def input_fingerprint(sc, data_file):
+    # Local input files are hashed, other filesystems are asked for their checksum (hdfs has one),
+    # falling back to the size and the modification time of the file
+    path, fs = hadoop_path(sc, data_file)
+    if fs.getUri().getScheme() == "file":
+        return file_hash(path.toUri().getPath())
+    checksum = fs.getFileChecksum(path)
+    if checksum is not None:
+        return checksum.toString()
+    status = fs.getFileStatus(path)
+    return f"{status.getPath().toString()}:{status.getLen()}:{status.getModificationTime()}"
+
+def corpus_cache_path(sc, cache_dir, data_file, stopwords, paragraphs):
+    # The cache entry depends on the input file, the stopword list and how documents are split
+    digest = hashlib.sha256()
+    digest.update(input_fingerprint(sc, data_file).encode())
+    digest.update("\n".join(sorted(stopwords)).encode())
+    digest.update(b"paragraphs" if paragraphs else b"lines")
+    return os.path.join(cache_dir, digest.hexdigest()[:32])
+
+def is_corpus_cached(sc, cache_path):
+    for name in ["vocabulary", "corpus"]:
+        path, fs = hadoop_path(sc, os.path.join(cache_path, name, "_SUCCESS"))
+        if not fs.exists(path):
+            return False
+    return True
+
+# Largest vocabulary which is broadcast to the executors to encode the corpus cache, the
+# documents of larger ones are encoded with a join on the cluster instead
+MAX_BROADCAST_VOCABULARY = 1000000
+
+def encode_documents(sc, words_rdd, num_partitions):
+    # Assign ids to the distinct words and map every document to an array of word ids, for the
+    # corpus cache. A vocabulary which fits is broadcast, and every partition encodes its own
+    # documents without a shuffle, a larger one stays on the cluster and is joined.
+    vocabulary_rdd = build_vocabulary_rdd(words_rdd).cache()
+    if vocabulary_rdd.count() > MAX_BROADCAST_VOCABULARY:
+        return vocabulary_rdd, encode_token_lists_rdd(words_rdd, vocabulary_rdd, num_partitions)
+    # The rdd is sorted by id, so the collected words get the same ids in the vocabulary
+    vocabulary = sc.broadcast(Vocabulary(vocabulary_rdd.keys().collect()))
+    documents_rdd = words_rdd.map(lambda words: array('i', [vocabulary.value.get_id(word) for word in words]))
+    return vocabulary_rdd, documents_rdd
+
+def save_corpus_cache(sc, documents_rdd, vocabulary_rdd, cache_path):
+    # Store the encoded corpus as two pickle files, the (word, id) pairs of the vocabulary and one
+    # array of word ids per document. The ids keep the token order, since the window mode needs
+    # the token stream and not just the unique words.
+    # Drop the leftovers of an interrupted save, spark refuses to overwrite them
+    for name in ["corpus", "vocabulary"]:
+        path, fs = hadoop_path(sc, os.path.join(cache_path, name))
+        fs.delete(path, True)
+    documents_rdd.saveAsPickleFile(os.path.join(cache_path, "corpus"))
+    # The vocabulary is written last, so that an interrupted save never looks like a valid cache
+    vocabulary_rdd.saveAsPickleFile(os.path.join(cache_path, "vocabulary"))
+
+def load_corpus_cache(sc, cache_path, num_partitions):
+    # Load the cached vocabulary as an rdd of (word, id), and the corpus as an rdd of word id arrays
+    vocabulary_rdd = sc.pickleFile(os.path.join(cache_path, "vocabulary")).cache()
+    return vocabulary_rdd, sc.pickleFile(os.path.join(cache_path, "corpus"), num_partitions)
+
 def co_occurence_mapper(document, query_word):
-    is_query_word_present = (True if query_word in document else False)
-    if not is_query_word_present:
-        return {
-            word: 0
-            for word in document if word != query_word
-        }
-        # return {}
-    
-    co_occurence_dict = {
-        word: 1
-        for word in document if word != query_word
-    }
-    return co_occurence_dict
+    # Emit (word, (document count, co-occurrence count)) once for every unique word of the document
+    unique_words = set(document)
+    is_query_word_present = (True if query_word in unique_words else False)
+    return [
+        (word, (1, 1 if (is_query_word_present and word != query_word) else 0))
+        for word in unique_words
+    ]
+
+def add_counts(x, y):
+    # Add two (document count, co-occurrence count) pairs
+    return (x[0] + y[0], x[1] + y[1])
+
+def salt_records(index, records, salt):
+    # Key every record by (word, salt), the salts go round robin over the records of the partition,
+    # so the records of every word are spread evenly over the `salt` keys
+    for position, (word, counts) in enumerate(records, index):
+        yield (word, position % salt), counts
+
+def sum_counts(records_rdd, num_partitions, salt):
+    # Sum up the (document count, co-occurrence count) records for each word. reduceByKey already
+    # combines the records map-side per partition (spilling to disk when memory runs short).
+    # With salting, the records of a word are first summed per (word, salt) key, which splits
+    # every hot key over `salt` reducers, and only the partial sums are combined per word afterwards.
+    if salt > 1:
+        salted_records_rdd = records_rdd.mapPartitionsWithIndex(lambda index, records: salt_records(index, records, salt))
+        records_rdd = salted_records_rdd.reduceByKey(add_counts, num_partitions).map(lambda x: (x[0][0], x[1]))
+    return records_rdd.reduceByKey(add_counts, num_partitions)
+
+def auto_input_partitions(sc, data_file):
+    # About two tasks per core, and input splits of at most 64MB
+    try:
+        path, fs = hadoop_path(sc, data_file)
+        size = fs.getContentSummary(path).getLength()
+    except Exception:
+        # e.g. a glob or a comma separated list of files, which `textFile(...)` accepts as well
+        size = 0
+    return max(2 * sc.defaultParallelism, int(math.ceil(size / (64 << 20))))
+
+# At most this many lines of a partition are handed over to the open paragraph of the previous
+# partition, which bounds what the driver collects. A paragraph which runs on for longer than
+# that past a partition boundary is split into two documents there.
+MAX_HEAD_LINES = 1000
+
+def partition_head_summary(lines):
+    # The lines of a partition before its first blank line (at most MAX_HEAD_LINES of them),
+    # and whether the head ends inside the partition, at a blank line or at the cap
+    head = []
+    for line in lines:
+        if line.strip() == "" or len(head) == MAX_HEAD_LINES:
+            return [(head, True)]
+        head.append(line)
+    return [(head, False)]
+
+def paragraph_mapper(index, lines, heads):
+    # Emit the paragraphs starting inside this partition. The leading lines belong to a paragraph
+    # of an earlier partition, and the last paragraph is completed with the heads of the next ones.
+    paragraphs = []
+    current = []
+    skipping = index > 0
+    skipped = 0
+    for line in lines:
+        if skipping and skipped == MAX_HEAD_LINES:
+            # The head was cut at the cap, the rest of it starts a new paragraph
+            skipping = False
+        if line.strip() == "":
+            if not skipping and current:
+                paragraphs.append(" ".join(current))
+            skipping = False
+            current = []
+        elif skipping:
+            skipped += 1
+        else:
+            current.append(line)
+
+    if not skipping:
+        for head, has_end in heads[index+1:]:
+            current.extend(head)
+            if has_end:
+                break
+        if current:
+            paragraphs.append(" ".join(current))
+    return paragraphs
+
+def split_into_paragraphs(lines_rdd):
+    # Turn an rdd of lines into an rdd of paragraphs, including paragraphs across partition boundaries
+    heads = lines_rdd.context.broadcast(lines_rdd.mapPartitions(partition_head_summary).collect())
+    return lines_rdd.mapPartitionsWithIndex(lambda index, lines: paragraph_mapper(index, lines, heads.value))
+
+def partition_token_summary(documents, window):
+    # Number of tokens in a partition, and its first (window - 1) tokens
+    num_tokens = 0
+    first_tokens = []
+    for document in documents:
+        num_tokens += len(document)
+        if len(first_tokens) < window - 1:
+            first_tokens.extend(document[:window - 1 - len(first_tokens)])
+    return [(num_tokens, first_tokens)]
+
+def window_counts_mapper(index, documents, query_word, window, halos):
+    # Count, for every word, the windows (starting inside this partition) that contain it, and the
+    # ones that contain both the word and the query word, without building the windows themselves.
+    # The window starting at s covers tokens [s, s + window - 1], so the token at position p
+    # belongs to the windows [p - window + 1, p].
+    tokens = [word for document in documents for word in document]
+    num_local_tokens = len(tokens)
+    tokens.extend(halos[index])
+    num_windows = max(0, min(num_local_tokens, len(tokens) - window + 1))
+
+    def covered_windows(p):
+        return max(0, p - window + 1), min(p, num_windows - 1)
+
+    # query_prefix[s] = number of windows among the first s windows which contain the query word
+    query_diff = [0] * (num_windows + 1)
+    for p, word in enumerate(tokens):
+        if word == query_word:
+            start, end = covered_windows(p)
+            if start <= end:
+                query_diff[start] += 1
+                query_diff[end+1] -= 1
+    query_prefix = array('l', [0]) * (num_windows + 1)
+    running = 0
+    for s in range(num_windows):
+        running += query_diff[s]
+        query_prefix[s+1] = query_prefix[s] + (1 if running > 0 else 0)
+
+    # Positions are visited in increasing order, so the covered windows of a word only grow to the right
+    last_covered = {}
+    counts = {}
+    for p, word in enumerate(tokens):
+        start, end = covered_windows(p)
+        start = max(start, last_covered.get(word, -1) + 1)
+        if start > end:
+            continue
+        last_covered[word] = end
+        document_count, co_occurence_count = counts.get(word, (0, 0))
+        document_count += end - start + 1
+        if word != query_word:
+            co_occurence_count += query_prefix[end+1] - query_prefix[start]
+        counts[word] = (document_count, co_occurence_count)
+    return counts.items()
+
+def window_count_records(documents_rdd, query_word, window):
+    # Total number of windows and the per-partition (word, (document count, co-occurrence count)) rdd
+    # for sliding windows of `window` tokens. Windows straddling a partition boundary are completed
+    # with the first (window - 1) tokens of the following partitions.
+    summaries = documents_rdd.mapPartitions(lambda documents: partition_token_summary(documents, window)).collect()
+    halos = []
+    for index in range(len(summaries)):
+        halo = []
+        for _, first_tokens in summaries[index+1:]:
+            if len(halo) >= window - 1:
+                break
+            halo.extend(first_tokens[:window - 1 - len(halo)])
+        halos.append(halo)
+
+    total_tokens = sum(num_tokens for num_tokens, _ in summaries)
+    num_windows = max(0, total_tokens - window + 1)
+    records_rdd = documents_rdd.mapPartitionsWithIndex(
+        lambda index, documents: window_counts_mapper(index, documents, query_word, window, halos)
+    )
+    return num_windows, records_rdd
 
 def calculate_pmi_score(p_x_y, p_x, p_y, n):
     # Compute the PMI for each word, simplifying the formula, we get
@@ -61,13 +353,314 @@ def calculate_pmi_score(p_x_y, p_x, p_y, n):
     value = (p_x_y * n) / (p_x * p_y)
     return math.log2(value)
 
+class CountMinSketch:
+    """
+        - Fixed size frequency table of `depth` rows, each with `width` counters
+        - Every row hashes an item to one counter, the estimate is the minimum over all rows
+        - Never underestimates, overestimates by at most epsilon * total with probability 1 - delta
+        - Sketches built with the same parameters can be merged by adding the tables
+    """
+    # A Mersenne prime, larger than any item key, for the universal hash family
+    PRIME = (1 << 61) - 1
+    # Fixed seed, so that sketches built on different executors agree on the hashes
+    SEED = 19
+
+    def __init__(self, epsilon, delta):
+        self.width = int(math.ceil(math.e / epsilon))
+        self.depth = int(math.ceil(math.log(1 / delta)))
+        self.total = 0
+        # Every row draws its own (a, b) of the hash ((a*key + b) mod PRIME) mod width. The
+        # coefficients must span the whole field, with small ones a*key + b stays below PRIME,
+        # and two items colliding in one row would then collide in every row.
+        rng = random.Random(CountMinSketch.SEED)
+        self.seeds = [(rng.randrange(1, CountMinSketch.PRIME), rng.randrange(CountMinSketch.PRIME)) for _ in range(self.depth)]
+        self.table = [array('q', bytes(8 * self.width)) for _ in range(self.depth)]
+
+    def buckets(self, item):
+        # Word ids are keys as they are, strings are keyed by a 64 bit blake2b digest
+        # (the builtin string hash is salted per process, and crc32 collides too often)
+        if isinstance(item, str):
+            item = int.from_bytes(hashlib.blake2b(item.encode(), digest_size=8).digest(), "little")
+        key = item % CountMinSketch.PRIME
+        return [((a*key + b) % CountMinSketch.PRIME) % self.width for a, b in self.seeds]
+
+    def add(self, item, count=1):
+        self.total += count
+        for row, bucket in zip(self.table, self.buckets(item)):
+            row[bucket] += count
+
+    def estimate(self, item):
+        return min(row[bucket] for row, bucket in zip(self.table, self.buckets(item)))
+
+    def merge(self, other):
+        self.total += other.total
+        for row, other_row in zip(self.table, other.table):
+            for i, value in enumerate(other_row):
+                if value:
+                    row[i] += value
+        return self
+
+
+class SpaceSaving:
+    """
+        - Space-saving heavy hitter summary which monitors at most `capacity` items
+        - An unmonitored item replaces the item with the minimum count and inherits that count as its error
+        - Every item with true count above total / capacity is guaranteed to be monitored
+        - Summaries can be merged, which keeps the `capacity` largest combined counts
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # Exactly one (count, item) entry per monitored item, the count may be stale (too low)
+        self.heap = []
+
+    def min_count(self):
+        if len(self.counts) < self.capacity:
+            return 0
+        while True:
+            count, item = self.heap[0]
+            if count == self.counts[item]:
+                return count
+            heapq.heapreplace(self.heap, (self.counts[item], item))
+
+    def add(self, item, count=1):
+        if item in self.counts:
+            self.counts[item] += count
+            return
+        if len(self.counts) < self.capacity:
+            self.counts[item] = count
+            self.errors[item] = 0
+            heapq.heappush(self.heap, (count, item))
+            return
+        # Evict the item with the minimum count
+        min_count = self.min_count()
+        _, evicted = heapq.heappop(self.heap)
+        self.counts.pop(evicted)
+        self.errors.pop(evicted)
+        self.counts[item] = min_count + count
+        self.errors[item] = min_count
+        heapq.heappush(self.heap, (min_count + count, item))
+
+    def merge(self, other):
+        # Items missing from one summary may have had up to its minimum count there
+        self_min, other_min = self.min_count(), other.min_count()
+        counts, errors = {}, {}
+        for item in set(self.counts) | set(other.counts):
+            counts[item] = self.counts.get(item, self_min) + other.counts.get(item, other_min)
+            errors[item] = self.errors.get(item, self_min) + other.errors.get(item, other_min)
+        kept = heapq.nlargest(self.capacity, counts, key=counts.get)
+        self.counts = {item: counts[item] for item in kept}
+        self.errors = {item: errors[item] for item in kept}
+        self.heap = [(count, item) for item, count in self.counts.items()]
+        heapq.heapify(self.heap)
+        return self
+
+    def items(self):
+        return list(self.counts.keys())
+
+
+def approx_seq_op(summaries, record, query_word):
+    # Add a single (word, (document count, co-occurrence count)) record to the per-partition summaries.
+    # The document count of the query word itself is kept exactly, a sketch estimate is only an
+    # upper bound and would report documents for a query word which is not in the corpus at all.
+    df_sketch, co_sketch, df_heavy_hitters, co_heavy_hitters, query_word_count = summaries
+    word, (document_count, co_occurence_count) = record
+    df_sketch.add(word, document_count)
+    df_heavy_hitters.add(word, document_count)
+    if co_occurence_count:
+        co_sketch.add(word, co_occurence_count)
+        co_heavy_hitters.add(word, co_occurence_count)
+    if word == query_word:
+        query_word_count += document_count
+    return df_sketch, co_sketch, df_heavy_hitters, co_heavy_hitters, query_word_count
+
+def approx_comb_op(summaries, other_summaries):
+    # Merge the summaries of two partitions
+    *sketches, query_word_count = summaries
+    *other_sketches, other_query_word_count = other_summaries
+    merged = [sketch.merge(other_sketch) for sketch, other_sketch in zip(sketches, other_sketches)]
+    return (*merged, query_word_count + other_query_word_count)
+
+def compute_approx_pmi(records_rdd, query_word, num_documents, options, metrics):
+    # Approximate PMI for candidate words using mergeable sketches, without an exact
+    # count per distinct word. Positive candidates are the heavy hitters among the
+    # co-occurring words, negative candidates are the overall heavy hitters.
+    epsilon, delta, capacity = options["epsilon"], options["delta"], options["heavy_hitters"]
+    zero_value = (
+        CountMinSketch(epsilon, delta),
+        CountMinSketch(epsilon, delta),
+        SpaceSaving(capacity),
+        SpaceSaving(capacity),
+        0,
+    )
+    with metrics.stage("counts"):
+        df_sketch, co_sketch, df_heavy_hitters, co_heavy_hitters, query_word_count = records_rdd.treeAggregate(
+            zero_value,
+            lambda summaries, record: approx_seq_op(summaries, record, query_word),
+            approx_comb_op,
+        )
+
+    with metrics.stage("pmi"):
+        candidates = (set(df_heavy_hitters.items()) | set(co_heavy_hitters.items())) - {query_word}
+        pmi_values = []
+        for word in candidates:
+            word_count = df_sketch.estimate(word)
+            # The co-occurrence count can never exceed either document frequency, and without
+            # the query word in the corpus there is nothing to look up
+            co_occurence_count = 0
+            if query_word_count > 0:
+                co_occurence_count = min(co_sketch.estimate(word), word_count, query_word_count)
+            pmi_values.append((word, calculate_pmi_score(co_occurence_count, query_word_count, word_count, num_documents)))
+        metrics.count("pmi_words", len(pmi_values))
+    return query_word_count, pmi_values
+
+def compute_exact_pmi(records_rdd, query_word, num_documents, options, metrics):
+    # Exact PMI for every word in the corpus, returned as a cached rdd of (word, pmi)
+
+    with metrics.stage("counts"):
+        # Sum up the document and co-occurrence counts for each word
+        counts_rdd = sum_counts(records_rdd, options["shuffle_partitions"], options["salt"]).cache()
+        # print_sample(counts_rdd_first_5=counts_rdd.take(5))
+
+        #  Calculate the count of the query word in this counts_rdd
+        # if the word is not present at all, set the value to 0
+        query_word_counts = counts_rdd.lookup(query_word)
+        query_word_count = query_word_counts[0][0] if query_word_counts else 0
+        # print_sample(query_word_count=query_word_count)
+
+    with metrics.stage("pmi"):
+        pmi_rdd = counts_rdd.filter(lambda x: x[0] != query_word).map(lambda x: (x[0], calculate_pmi_score(x[1][1], query_word_count, x[1][0], num_documents))).cache()
+        metrics.count("pmi_words", pmi_rdd.count())
+        # print_sample(pmi_rdd_first_5=pmi_rdd.take(5))
+    return query_word_count, pmi_rdd
+
+class JobMetrics:
+    """
+        - Records the wall time of every logical stage of the job and a few counters
+        - Every logical stage runs under its own spark job group, so the spark stages it
+          launched can be looked up in the status tracker afterwards
+        - Job groups can also be nested without a wall time of their own, e.g. for the spark
+          stages reading the input, whose work is pipelined with the preprocessing
+        - Record counts, shuffle sizes and run times of those spark stages come from the
+          monitoring REST api of the spark UI (left out when the UI is disabled)
+    """
+    STAGE_FIELDS = [
+        "inputRecords", "inputBytes", "outputRecords", "outputBytes",
+        "shuffleReadRecords", "shuffleReadBytes", "shuffleWriteRecords", "shuffleWriteBytes",
+        "executorRunTime",
+    ]
+
+    def __init__(self, sc):
+        self.sc = sc
+        self.groups = []
+        self.group_stack = []
+        self.stage_times = {}
+        self.counters = {}
+
+    @contextmanager
+    def job_group(self, name):
+        # Run the spark jobs launched inside under the job group `name`, and restore the enclosing
+        # group afterwards (or clear it), so that later jobs are not billed to this group
+        if name not in self.groups:
+            self.groups.append(name)
+        self.group_stack.append(name)
+        self.sc.setJobGroup(name, name)
+        try:
+            yield
+        finally:
+            self.group_stack.pop()
+            if self.group_stack:
+                self.sc.setJobGroup(self.group_stack[-1], self.group_stack[-1])
+            else:
+                self.sc.setLocalProperty("spark.jobGroup.id", None)
+                self.sc.setLocalProperty("spark.job.description", None)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            with self.job_group(name):
+                yield
+        finally:
+            self.stage_times[name] = self.stage_times.get(name, 0) + time.perf_counter() - start
+
+    def count(self, name, value):
+        self.counters[name] = value
+
+    def fetch_spark_stage(self, stage_id):
+        # Totals of all attempts of a spark stage which actually ran, or None if the REST api is unavailable
+        if not self.sc.uiWebUrl:
+            return None
+        import urllib.request
+        url = f"{self.sc.uiWebUrl}/api/v1/applications/{self.sc.applicationId}/stages/{stage_id}"
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                attempts = json.load(response)
+        except (OSError, ValueError):
+            return None
+        attempts = [attempt for attempt in attempts if attempt.get("status") != "SKIPPED"]
+        return {field: sum(attempt.get(field, 0) for attempt in attempts) for field in JobMetrics.STAGE_FIELDS}
+
+    def spark_jobs(self):
+        # The job ids of every job group, and the spark stages each group ran. A job lists the stages
+        # it reused from an earlier job as well (e.g. a shuffle whose output is still around), under
+        # the same stage id, so every stage is only attributed to the first job which lists it.
+        tracker = self.sc.statusTracker()
+        job_ids = {}
+        jobs = []
+        for name in self.groups:
+            job_ids[name] = tracker.getJobIdsForGroup(name)
+            for job_id in job_ids[name]:
+                job_info = tracker.getJobInfo(job_id)
+                if job_info is not None:
+                    jobs.append((job_id, name, job_info.stageIds))
+
+        stage_ids = {name: set() for name in self.groups}
+        attributed = set()
+        for _, name, job_stage_ids in sorted(jobs, key=lambda x: x[0]):
+            for stage_id in job_stage_ids:
+                if stage_id not in attributed:
+                    attributed.add(stage_id)
+                    stage_ids[name].add(stage_id)
+        return job_ids, stage_ids
+
+    def spark_stage_summary(self, job_ids, stage_ids):
+        # Sum up the spark stages of all jobs launched within a job group
+        summary = {"jobs": len(job_ids), "spark_stages": len(stage_ids)}
+        for stage_id in sorted(stage_ids):
+            details = self.fetch_spark_stage(stage_id)
+            if details is None:
+                continue
+            for field, value in details.items():
+                summary[field] = summary.get(field, 0) + value
+        return summary
+
+    def summary(self):
+        job_ids, stage_ids = self.spark_jobs()
+        stages = {}
+        for name in self.groups:
+            stages[name] = {}
+            if name in self.stage_times:
+                stages[name]["wall_time_s"] = round(self.stage_times[name], 3)
+            stages[name].update(self.spark_stage_summary(job_ids[name], stage_ids[name]))
+        return {
+            "total_wall_time_s": round(sum(self.stage_times.values()), 3),
+            "stages": stages,
+            "counters": self.counters,
+        }
+
 def init_pyspark_application():
-    # Initialize Spark
+    # Initialize Spark. pyspark is imported here and not at the top, so that bad arguments
+    # are reported without paying for the pyspark import and the JVM startup.
+    from pyspark import SparkConf, SparkContext
     conf = SparkConf()
     conf.setAppName('WordAssociationUsingSpark')
     # conf.setMaster("local")
     sc = SparkContext(conf=conf)
     # sc.setLogLevel("OFF")
+    # Ship the shared vocabulary module to the executors
+    sc.addPyFile(os.path.join(VOCABULARY_MODULE_DIR, "vocabulary.py"))
     return sc
 
 def finish_pyspark_application(sc):
@@ -75,8 +668,8 @@ def finish_pyspark_application(sc):
     sc.stop()
 
 def main():
-    sc = init_pyspark_application()
-    data_file, query_word, k, stopword_file = read_cmd_args()
+    # Everything which can fail on bad input runs before spark is started
+    data_file, query_word, k, stopword_file, options = read_cmd_args()
 
     # print_sample(
     #     data_file=data_file, 
@@ -88,42 +681,93 @@ def main():
     stopwords = read_stopwords(stopword_file)
     # print_sample(stopwords=stopwords)
 
-    documents = sc.textFile(data_file)
-    documents_rdd = documents.map(lambda doc: preprocess_document(doc, stopwords)).cache()
-    # print_sample(documents_rdd_first_5=documents_rdd.take(5))
+    sc = init_pyspark_application()
+    metrics = JobMetrics(sc)
 
-    # Value of N
-    num_documents = documents_rdd.count()
-    # print_sample(num_documents=num_documents)
+    cache_path = None
+    if options["cache_dir"]:
+        cache_path = corpus_cache_path(sc, options["cache_dir"], data_file, stopwords, options["paragraphs"])
 
-    documents_with_unique_words_list_rdd = documents_rdd.map(lambda doc_word_list: set(doc_word_list))
-    # print_sample(documents_with_unique_words_list_rdd_first_5=documents_with_unique_words_list_rdd.take(5))
-    
-    word_present_in_documents_count = documents_with_unique_words_list_rdd.flatMap(lambda x:list(x)).countByValue()
-    # print_sample(word_present_in_documents_count=word_present_in_documents_count)
+    if options["input_partitions"] <= 0:
+        options["input_partitions"] = auto_input_partitions(sc, data_file)
+    if options["shuffle_partitions"] <= 0:
+        options["shuffle_partitions"] = options["input_partitions"]
+    metrics.count("input_partitions", options["input_partitions"])
+    metrics.count("shuffle_partitions", options["shuffle_partitions"])
 
-    #  Calculate the count of the query word in this word_present_in_documents_rdd
-    # if the word is not present at all, set the value to 0
-    query_word_count = word_present_in_documents_count.get(query_word, 0)
-    # print_sample(query_word_count=query_word_count)
+    is_cached = cache_path is not None and is_corpus_cached(sc, cache_path)
 
-    # Compute co-occurrence between query_word and all other words in the list
-    co_occurence_dicts_rdd = documents_rdd.map(lambda doc: co_occurence_mapper(doc, query_word))
-    # print_sample(co_occurence_dicts_rdd_first_5=co_occurence_dicts_rdd.take(5))
+    with metrics.stage("preprocess"):
+        # Transformations are lazy, the input is read by the first action on the documents, which
+        # counts them. Its spark stages are reported as "read" (input size and run time), their
+        # wall time is part of "preprocess" since the preprocessing is pipelined with the read.
+        with metrics.job_group("read"):
+            if is_cached:
+                vocabulary_rdd, documents_rdd = load_corpus_cache(sc, cache_path, options["input_partitions"])
+            else:
+                documents = sc.textFile(data_file, options["input_partitions"])
+                if options["paragraphs"]:
+                    documents = split_into_paragraphs(documents)
+                documents_rdd = documents.map(lambda doc: preprocess_document(doc, stopwords))
+            documents_rdd = documents_rdd.cache()
+            # print_sample(documents_rdd_first_5=documents_rdd.take(5))
+            metrics.count("documents_read", documents_rdd.count())
 
-    # Sum up the co-occurrence counts for each word
-    co_occurence_counts_rdd = co_occurence_dicts_rdd.flatMap(lambda x:x.items()).reduceByKey(add)
-    # print_sample(co_occurence_counts_rdd_first_5=co_occurence_counts_rdd.take(5))
+        if cache_path and not is_cached:
+            words_rdd = documents_rdd
+            vocabulary_rdd, documents_rdd = encode_documents(sc, words_rdd, options["input_partitions"])
+            # Saving computes the encoded documents, which keeps them cached for the counts below
+            documents_rdd = documents_rdd.cache()
+            save_corpus_cache(sc, documents_rdd, vocabulary_rdd, cache_path)
+            words_rdd.unpersist()
+        elif not is_cached:
+            # Without a corpus cache the words are counted as they are, assigning ids would only
+            # add a shuffle over the whole corpus before the counting
+            vocabulary_rdd = None
 
-    pmi_rdd = co_occurence_counts_rdd.map(lambda x: (x[0], calculate_pmi_score(x[1], query_word_count, word_present_in_documents_count.get(x[0]), num_documents))) 
-    # print_sample(pmi_rdd_first_5=pmi_rdd.take(5))
+        # With a corpus cache the query word is an id as well (-1 if it is not in the corpus)
+        if vocabulary_rdd is None:
+            query_word_id = query_word
+        else:
+            metrics.count("vocabulary_size", vocabulary_rdd.count())
+            query_word_ids = vocabulary_rdd.lookup(query_word)
+            query_word_id = query_word_ids[0] if query_word_ids else -1
 
-    # Sort the PMI values in descending/ascending order
-    pmi_rdd_desc_sorted = pmi_rdd.sortBy(lambda x: x[1], ascending=False)
-    pmi_rdd_asc_sorted = pmi_rdd.sortBy(lambda x: x[1], ascending=True)
+    # Value of N, and the (word, (document count, co-occurrence count)) records to sum up
+    with metrics.stage("counts"):
+        if options["window"] > 0:
+            num_documents, records_rdd = window_count_records(documents_rdd, query_word_id, options["window"])
+        else:
+            # One record per unique word of every document, streamed straight into the sketches in
+            # approximate mode, or summed up by reduceByKey for the exact counts
+            num_documents = metrics.counters["documents_read"]
+            records_rdd = documents_rdd.flatMap(lambda doc: co_occurence_mapper(doc, query_word_id))
+    metrics.count("documents", num_documents)
+    # print_sample(num_documents=num_documents)
+
+    if options["approx"]:
+        query_word_count, pmi_values = compute_approx_pmi(records_rdd, query_word_id, num_documents, options, metrics)
+    else:
+        query_word_count, pmi_rdd = compute_exact_pmi(records_rdd, query_word_id, num_documents, options, metrics)
+    # Documents (or windows) containing the query word
+    metrics.count("query_documents", query_word_count)
 
-    positive_values = pmi_rdd_desc_sorted.take(k)
-    negative_values = pmi_rdd_asc_sorted.take(k)
+    with metrics.stage("top_k"):
+        if options["approx"]:
+            # Sort the PMI values of the candidates in descending/ascending order
+            positive_values = sorted(pmi_values, key=lambda x: x[1], reverse=True)[:k]
+            negative_values = sorted(pmi_values, key=lambda x: x[1])[:k]
+        else:
+            # Top k in descending/ascending order of PMI, each partition only sends its own top k
+            # to the driver instead of sorting the whole rdd
+            positive_values = pmi_rdd.takeOrdered(k, key=lambda x: -x[1])
+            negative_values = pmi_rdd.takeOrdered(k, key=lambda x: x[1])
+
+        # Decode the word ids of the results back into words
+        if vocabulary_rdd is not None:
+            words = decode_ids_rdd(vocabulary_rdd, [word_id for word_id, _ in positive_values + negative_values])
+            positive_values = [(words[word_id], pmi_value) for word_id, pmi_value in positive_values]
+            negative_values = [(words[word_id], pmi_value) for word_id, pmi_value in negative_values]
 
     print_sample()
 
@@ -144,6 +788,9 @@ def main():
     
     print_sample()
 
+    # One line json summary of the run, for comparing run logs
+    print(f"METRICS:: {json.dumps(metrics.summary())}")
+
     finish_pyspark_application(sc)
 
 if __name__ == '__main__':
@@ -0,0 +1,64 @@
+## Measures how fast every assignment script starts up and rejects bad command line arguments,
+## and which top level imports that startup spends its time on (from `python -X importtime`)
+##
+## Usage: python startup_benchmark.py [number_of_runs]
+
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = [
+    "assignment-1/assignment-1-19CS30014.py",
+    "assignment-2/assignment-2-19CS30014.py",
+    "assignment-3/assignment-3-19CS30014.py",
+]
+
+try:
+    runs = int(sys.argv[1])
+except:
+    runs = 10
+
+def run_script(script, extra_python_args=()):
+    # Run the script without arguments, so that it stops at the argument validation
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, *extra_python_args, os.path.join(ROOT, script)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    return time.perf_counter() - start, result.stderr
+
+def top_level_import_times(stderr):
+    # Lines look like "import time:  self [us] | cumulative | imported package", nested imports are indented
+    import_times = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip() == "cumulative" or name.startswith("  "):
+            continue
+        import_times.append((int(cumulative), name.strip()))
+    import_times.sort(reverse=True)
+    return import_times
+
+# Interpreter startup on its own, as a baseline
+baseline_times = []
+for _ in range(runs):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"])
+    baseline_times.append(time.perf_counter() - start)
+baseline_times.sort()
+print(f"{'python -c pass':45s} median {1000*baseline_times[len(baseline_times)//2]:8.1f} ms")
+print(100*"-")
+
+for script in SCRIPTS:
+    times = sorted(run_script(script)[0] for _ in range(runs))
+    print(f"{script:45s} median {1000*times[len(times)//2]:8.1f} ms   max {1000*times[-1]:8.1f} ms")
+
+    _, stderr = run_script(script, ["-X", "importtime"])
+    for cumulative, name in top_level_import_times(stderr)[:5]:
+        print(f"    {name:41s} {cumulative/1000:8.1f} ms")
+    print(100*"-")
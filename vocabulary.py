@@ -0,0 +1,145 @@
+"""
+Shared vocabulary for the text processing assignments.
+
+Maps tokens to dense integer ids, so that the pipelines can count ints (or n-grams packed
+into a single int) instead of strings, and only decode the few tokens of the final output.
+"""
+from array import array
+
+# numpy is optional, and only imported by `get_numpy()` once n-grams are actually packed,
+# so that scripts which fail early (e.g. on bad arguments) do not pay for importing it
+_numpy = None
+
+# Largest value a packed n-gram may take to fit into an int64
+MAX_PACKED_VALUE = (1 << 63) - 1
+
+
+class Vocabulary:
+    """
+        - Maps tokens to dense integer ids 0, 1, 2, ... in the order they are first added
+        - Small enough to be broadcast to the executors of a spark job, larger vocabularies stay
+          on the cluster as an rdd of (token, id), see `build_vocabulary_rdd(...)`
+    """
+    def __init__(self, tokens=()):
+        self.token_to_id = {}
+        self.id_to_token = []
+        for token in tokens:
+            self.add(token)
+
+    def __len__(self):
+        return len(self.id_to_token)
+
+    def add(self, token):
+        """
+            - Returns the id of the token, assigning the next free id to unseen tokens
+        """
+        token_id = self.token_to_id.get(token)
+        if token_id is None:
+            token_id = len(self.id_to_token)
+            self.token_to_id[token] = token_id
+            self.id_to_token.append(token)
+        return token_id
+
+    def get_id(self, token, default=-1):
+        return self.token_to_id.get(token, default)
+
+    def encode(self, tokens):
+        """
+            - Returns the ids of the tokens as a compact array, adding unseen tokens to the vocabulary
+        """
+        return array('i', [self.add(token) for token in tokens])
+
+    def decode(self, ids):
+        return [self.id_to_token[token_id] for token_id in ids]
+
+
+def build_vocabulary_rdd(token_lists_rdd):
+    """
+        - Assigns dense ids to the distinct tokens of a spark rdd of token lists in sorted order, on the cluster
+        - Returns an rdd of (token, id), the vocabulary is never collected in one place
+        - The ids only depend on the tokens and not on the order a shuffle returns them in, so
+          they stay the same when the rdd is recomputed (e.g. after its cached blocks were evicted)
+    """
+    return token_lists_rdd.flatMap(lambda tokens: tokens).distinct().sortBy(lambda token: token).zipWithIndex()
+
+def encode_token_lists_rdd(token_lists_rdd, vocabulary_rdd, num_partitions):
+    """
+        - Maps every token list of a spark rdd to an array of ids, with a join against the vocabulary rdd
+        - Keeps the order of the lists and of the tokens inside them, and keeps empty lists
+        - Shuffles every token occurrence, only meant for vocabularies too large to be broadcast
+    """
+    indexed_rdd = token_lists_rdd.zipWithIndex()
+    # (token, (list index, position)) joined with (token, id) gives (list index, (position, id))
+    positions_rdd = indexed_rdd.flatMap(
+        lambda x: [(token, (x[1], position)) for position, token in enumerate(x[0])]
+    )
+    ids_rdd = positions_rdd.join(vocabulary_rdd, num_partitions).map(lambda x: (x[1][0][0], (x[1][0][1], x[1][1])))
+    list_keys_rdd = indexed_rdd.map(lambda x: (x[1], None))
+    return list_keys_rdd.cogroup(ids_rdd, num_partitions).sortByKey(numPartitions=num_partitions).map(
+        lambda x: array('i', [token_id for _, token_id in sorted(x[1][1])])
+    )
+
+def decode_ids_rdd(vocabulary_rdd, ids):
+    """
+        - Looks up the tokens of a few ids in the vocabulary rdd, returns a dict of id -> token
+    """
+    wanted_ids = set(ids)
+    return vocabulary_rdd.filter(lambda x: x[1] in wanted_ids).map(lambda x: (x[1], x[0])).collectAsMap()
+
+
+def get_numpy():
+    """
+        - Imports numpy on first use, returns None if it is not installed
+    """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            return None
+        _numpy = numpy
+    return _numpy
+
+def can_pack_ngrams(n, vocabulary_size):
+    """
+        - Whether n-grams over a vocabulary of this size can be packed into int64 with numpy
+    """
+    return get_numpy() is not None and max(vocabulary_size, 1) ** n <= MAX_PACKED_VALUE
+
+def pack_ngrams(ids, n, vocabulary_size):
+    """
+        - Packs every n consecutive ids into the single int64 id_1 * V^(n-1) + ... + id_n, V being the vocabulary size
+        - Returns an empty array if there are fewer than n ids
+    """
+    np = get_numpy()
+    ids = np.asarray(ids, dtype=np.int64)
+    num_ngrams = len(ids) - n + 1
+    if num_ngrams <= 0:
+        return np.zeros(0, dtype=np.int64)
+    packed = np.zeros(num_ngrams, dtype=np.int64)
+    for i in range(n):
+        packed = packed * vocabulary_size + ids[i:i + num_ngrams]
+    return packed
+
+def unpack_ngram(value, n, vocabulary_size):
+    """
+        - Inverse of `pack_ngrams(...)` for a single packed value, returns a tuple of ids
+    """
+    value = int(value)
+    ids = []
+    for _ in range(n):
+        value, token_id = divmod(value, vocabulary_size)
+        ids.append(token_id)
+    return tuple(reversed(ids))
+
+def most_common_packed(packed_arrays, k):
+    """
+        - Counts the values of several packed arrays together with numpy, and returns the k most common ones
+        - Returns a list of (value, count), ties are broken by the first occurrence like `Counter.most_common(...)`
+    """
+    if not packed_arrays:
+        return []
+    np = get_numpy()
+    values, first_index, counts = np.unique(np.concatenate(packed_arrays), return_index=True, return_counts=True)
+    order = np.lexsort((first_index, -counts))[:k]
+    return [(int(values[i]), int(counts[i])) for i in order]